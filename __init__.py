@@ -3,9 +3,11 @@
 # the full copyright notices and license terms.
 
 from trytond.pool import Pool
+from . import account
 from . import company
 from . import party
 from . import arba
+from . import census
 
 __all__ = ['register']
 
@@ -13,11 +15,23 @@ __all__ = ['register']
 def register():
     Pool.register(
         company.Company,
+        account.Tax,
+        account.Invoice,
+        account.TaxWithholdingSubmitted,
         party.Party,
+        party.PartyWithholdingIIBB,
         party.Cron,
+        census.ARBACensus,
+        census.ARBACensusJob,
+        census.ImportARBACensusStart,
+        arba.ARBAPeriodTotal,
+        arba.RebuildARBAPeriodTotalStart,
         arba.ExportARBARN3811Start,
+        arba.ExportARBARN3811Preview,
         arba.ExportARBARN3811Result,
         module='account_arba', type_='model')
     Pool.register(
+        arba.RebuildARBAPeriodTotal,
         arba.ExportARBARN3811,
+        census.ImportARBACensus,
         module='account_arba', type_='wizard')
@@ -0,0 +1,171 @@
+# This file is part of the account_arba module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from collections import defaultdict
+from decimal import Decimal
+
+from trytond.model import fields, Index
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+
+class Tax(metaclass=PoolMeta):
+    __name__ = 'account.tax'
+
+    def _process_tax(self, price_unit):
+        rate = self._get_arba_rate_percepcion()
+        if rate is None:
+            return super()._process_tax(price_unit)
+        return {
+            'base': price_unit,
+            'amount': price_unit * rate,
+            'tax': self,
+            }
+
+    def _get_arba_rate_percepcion(self):
+        """ Alícuota de percepción ARBA del tercero del contexto cuando el
+        impuesto es el régimen de percepción de la empresa.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        context = Transaction().context
+
+        if (self.type != 'percentage'
+                or not context.get('company')
+                or not context.get('party')):
+            return
+        company = Company(context['company'])
+        if company.arba_regimen_percepcion != self:
+            return
+        party = Party(context['party'])
+        rate_percepcion, _ = Party.get_arba_rates(
+            [party], company=company)[party.id]
+        if rate_percepcion is None:
+            return
+        return rate_percepcion / 100
+
+
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        # 1.2. Percepciones: customer invoices of the selected moves
+        cls._sql_indexes.add(
+            Index(t, (t.move, Index.Range()), where=t.type == 'out'))
+
+    @fields.depends('party')
+    def _get_tax_context(self):
+        context = super()._get_tax_context()
+        if self.party:
+            context['party'] = self.party.id
+        return context
+
+    @classmethod
+    def _post(cls, invoices):
+        pool = Pool()
+        PeriodTotal = pool.get('arba.period.total')
+        before = cls._get_arba_period_totals(invoices)
+        super()._post(invoices)
+        PeriodTotal.update_totals(
+            before, cls._get_arba_period_totals(cls.browse(invoices)))
+
+    @classmethod
+    def cancel(cls, invoices):
+        pool = Pool()
+        PeriodTotal = pool.get('arba.period.total')
+        before = cls._get_arba_period_totals(invoices)
+        super().cancel(invoices)
+        PeriodTotal.update_totals(
+            before, cls._get_arba_period_totals(cls.browse(invoices)))
+
+    @classmethod
+    def _get_arba_period_totals(cls, invoices):
+        """ Aportes de las facturas a los totales del lote 1.2. """
+        totals = []
+        for invoice in invoices:
+            arba_regimen_percepcion = invoice.company.arba_regimen_percepcion
+            if (invoice.type != 'out'
+                    or not arba_regimen_percepcion
+                    or not invoice.move
+                    or not (invoice.state in {'posted', 'paid'}
+                        or (invoice.state == 'cancelled'
+                            and invoice.number))):
+                continue
+            tax_amount = sum((t.amount for t in invoice.taxes
+                    if t.tax == arba_regimen_percepcion), Decimal(0))
+            if not tax_amount:
+                continue
+            totals.append((invoice.company.id, invoice.move.date,
+                    invoice.untaxed_amount, tax_amount,
+                    Decimal(0), Decimal(0)))
+        return totals
+
+
+class TaxWithholdingSubmitted(metaclass=PoolMeta):
+    __name__ = 'account.retencion.efectuada'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        # 1.9. Retenciones: issued withholdings of a tax ordered by date
+        cls._sql_indexes.add(
+            Index(t,
+                (t.tax, Index.Equality()),
+                (t.date, Index.Range()),
+                where=t.state == 'issued'))
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        PeriodTotal = pool.get('arba.period.total')
+        retenciones = super().create(vlist)
+        PeriodTotal.update_totals(
+            [], cls._get_arba_period_totals(retenciones))
+        return retenciones
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        PeriodTotal = pool.get('arba.period.total')
+        retenciones = sum(args[::2], [])
+        before = cls._get_arba_period_totals(cls.browse(retenciones))
+        super().write(*args)
+        PeriodTotal.update_totals(
+            before, cls._get_arba_period_totals(cls.browse(retenciones)))
+
+    @classmethod
+    def delete(cls, retenciones):
+        pool = Pool()
+        PeriodTotal = pool.get('arba.period.total')
+        before = cls._get_arba_period_totals(retenciones)
+        super().delete(retenciones)
+        PeriodTotal.update_totals(before, [])
+
+    @classmethod
+    def _get_arba_period_totals(cls, retenciones):
+        """ Aportes de las retenciones a los totales del lote 1.9. """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        companies = defaultdict(list)
+        for company in Company.search([
+                    ('arba_regimen_retencion', '!=', None),
+                    ]):
+            companies[company.arba_regimen_retencion].append(company.id)
+        if not companies:
+            return []
+
+        totals = []
+        for retencion in retenciones:
+            if retencion.state != 'issued' or not retencion.payment_amount:
+                continue
+            for company_id in companies.get(retencion.tax, []):
+                totals.append((company_id, retencion.date,
+                        Decimal(0), Decimal(0),
+                        retencion.payment_amount, retencion.amount))
+        return totals
@@ -2,19 +2,33 @@
 # This file is part of the account_arba module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+from collections import defaultdict
 from decimal import Decimal
-import stdnum.ar.cuit as cuit
 from io import BytesIO
 import zipfile
 
-from trytond.model import fields, ModelView
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+
+from trytond.config import config
+from trytond.model import fields, Index, ModelSQL, ModelView
+from trytond.pyson import Bool, Eval
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 
 import logging
 logger = logging.getLogger(__name__)
 
+ZIP_COMPRESSIONS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+    }
+
 
 class ARBARN3811(object):
     """ Registro general de campos.
@@ -124,6 +138,7 @@ class ARBARN3811(object):
 
     def _check_vat_number(self, vat_number):
         """ Valida CUIT corto (sin separador) para Argentina. """
+        import stdnum.ar.cuit as cuit
         if (vat_number.isdigit() and
                 len(vat_number) == 11 and
                 cuit.is_valid(vat_number)):
@@ -227,6 +242,170 @@ class LoteImportacion19(ARBARN3811):
             ]
 
 
+class ARBAPeriodTotal(ModelSQL, ModelView):
+    'ARBA Period Total'
+    __name__ = 'arba.period.total'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    date = fields.Date('Date', required=True, readonly=True,
+        help='First day of the fortnight.')
+    percepcion_base = fields.Numeric('Percepción base', digits=(16, 2),
+        readonly=True)
+    percepcion_amount = fields.Numeric('Percepción amount', digits=(16, 2),
+        readonly=True)
+    retencion_base = fields.Numeric('Retención base', digits=(16, 2),
+        readonly=True)
+    retencion_amount = fields.Numeric('Retención amount', digits=(16, 2),
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.company, Index.Equality()),
+                (t.date, Index.Range())))
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @staticmethod
+    def _get_period_date(date):
+        return date.replace(day=1 if date.day <= 15 else 16)
+
+    @classmethod
+    def update_totals(cls, before, after):
+        """ Aplica la diferencia entre los aportes previos y posteriores.
+        Cada aporte es una tupla (empresa, fecha, base percepción,
+        importe percepción, base retención, importe retención) o None.
+        """
+        deltas = defaultdict(lambda: [Decimal(0)] * 4)
+        for sign, values in [(-1, before), (1, after)]:
+            for value in filter(None, values):
+                company, date, *amounts = value
+                delta = deltas[(company, cls._get_period_date(date))]
+                for i, amount in enumerate(amounts):
+                    delta[i] += sign * (amount or 0)
+        deltas = {k: v for k, v in deltas.items() if any(v)}
+        if not deltas:
+            return
+
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        columns = [table.percepcion_base, table.percepcion_amount,
+            table.retencion_base, table.retencion_amount]
+
+        def update(company, date, amounts):
+            cursor.execute(*table.update(
+                    columns + [table.write_date],
+                    [c + a for c, a in zip(columns, amounts)]
+                    + [CurrentTimestamp()],
+                    where=(table.company == company)
+                    & (table.date == date)))
+            return cursor.rowcount
+
+        for (company, date), amounts in sorted(deltas.items()):
+            if update(company, date, amounts):
+                continue
+            # Only lock when a new period starts
+            cls.lock()
+            if update(company, date, amounts):
+                continue
+            cursor.execute(*table.insert(
+                    [table.create_uid, table.create_date,
+                        table.company, table.date] + columns,
+                    [[transaction.user, CurrentTimestamp(), company, date]
+                        + amounts]))
+
+    @classmethod
+    def get_totals(cls, company, start_date, end_date):
+        """ Devuelve (base percepción, importe percepción, base retención,
+        importe retención) de las quincenas entre las fechas.
+        """
+        names = ['percepcion_base', 'percepcion_amount',
+            'retencion_base', 'retencion_amount']
+        totals = [Decimal(0)] * 4
+        # Read from the database as update_totals writes with SQL
+        for total in cls.search_read([
+                    ('company', '=', company),
+                    ('date', '>=', cls._get_period_date(start_date)),
+                    ('date', '<=', end_date),
+                    ], fields_names=names):
+            totals = [t + (total[n] or 0) for t, n in zip(totals, names)]
+        return tuple(totals)
+
+    @classmethod
+    def rebuild(cls, company, start_date, end_date):
+        """ Recalcula los totales de las quincenas entre las fechas. """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+        start_date = cls._get_period_date(start_date)
+        if end_date.day <= 15:
+            end_date = end_date.replace(day=15)
+        else:
+            end_date = (end_date.replace(day=28)
+                + datetime.timedelta(days=4)).replace(day=1)
+            end_date -= datetime.timedelta(days=1)
+        cls.delete(cls.search([
+                    ('company', '=', company),
+                    ('date', '>=', start_date),
+                    ('date', '<=', end_date),
+                    ]))
+
+        # The regimen may be shared, keep only the company contributions
+        def company_totals(totals):
+            return [t for t in totals if t[0] == company.id]
+
+        invoices = Invoice.search(
+            ExportARBARN3811._get_lote12_domain(
+                company, start_date, end_date))
+        cls.update_totals([],
+            company_totals(Invoice._get_arba_period_totals(invoices)))
+        if company.arba_regimen_retencion:
+            retenciones = TaxWithholdingSubmitted.search(
+                ExportARBARN3811._get_lote19_domain(
+                    company.arba_regimen_retencion, start_date, end_date))
+            cls.update_totals([], company_totals(
+                    TaxWithholdingSubmitted._get_arba_period_totals(
+                        retenciones)))
+
+
+class RebuildARBAPeriodTotalStart(ModelView):
+    'Rebuild ARBA Period Totals'
+    __name__ = 'arba.period.total.rebuild.start'
+
+    start_date = fields.Date('Start date', required=True)
+    end_date = fields.Date('End date', required=True)
+
+
+class RebuildARBAPeriodTotal(Wizard):
+    'Rebuild ARBA Period Totals'
+    __name__ = 'arba.period.total.rebuild'
+
+    start = StateView('arba.period.total.rebuild.start',
+        'account_arba.arba_period_total_rebuild_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Rebuild', 'rebuild', 'tryton-ok', default=True),
+            ])
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        pool = Pool()
+        Company = pool.get('company.company')
+        PeriodTotal = pool.get('arba.period.total')
+        company = Company(Transaction().context['company'])
+        PeriodTotal.rebuild(
+            company, self.start.start_date, self.start.end_date)
+        return 'end'
+
+    def end(self):
+        return 'reload'
+
+
 class ExportARBARN3811Start(ModelView):
     'Retenciones y Percepciones de Ingresos Brutos (ARBA RN Nº 38/11)'
     __name__ = 'arba.rn3811.start'
@@ -235,6 +414,41 @@ class ExportARBARN3811Start(ModelView):
     end_date = fields.Date('End date', required=True)
     csv_format = fields.Boolean('CSV format',
         help='Check this box if you want export to csv format.')
+    split_periods = fields.Boolean('Split by period',
+        help='Check this box to export one file for each ARBA period '
+        'between the start and end dates.')
+    period_type = fields.Selection([
+        ('month', 'Monthly'),
+        ('fortnight', 'Fortnightly'),
+        ], 'Period type', sort=False,
+        states={
+            'invisible': ~Eval('split_periods'),
+            'required': Bool(Eval('split_periods')),
+            })
+    single_archive = fields.Boolean('Single archive',
+        help='Check this box to bundle both lotes into one archive.')
+
+    @staticmethod
+    def default_period_type():
+        return 'month'
+
+
+class ExportARBARN3811Preview(ModelView):
+    'Retenciones y Percepciones de Ingresos Brutos (ARBA RN Nº 38/11)'
+    __name__ = 'arba.rn3811.preview'
+
+    lote12_lines = fields.Integer('Lines', readonly=True)
+    lote12_rejected_cuit = fields.Integer('Rejected without CUIT',
+        readonly=True)
+    lote12_base = fields.Numeric('Base', digits=(16, 2), readonly=True)
+    lote12_amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    lote19_lines = fields.Integer('Lines', readonly=True)
+    lote19_rejected_cuit = fields.Integer('Rejected without CUIT',
+        readonly=True)
+    lote19_rejected_base = fields.Integer('Rejected without base',
+        readonly=True)
+    lote19_base = fields.Numeric('Base', digits=(16, 2), readonly=True)
+    lote19_amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
 
 
 class ExportARBARN3811Result(ModelView):
@@ -243,12 +457,32 @@ class ExportARBARN3811Result(ModelView):
 
     lote12_file = fields.Binary(
         '1.2. Percepciones Act. 7 método Percibido (quincenal)',
-        filename='lote12_filename', readonly=True)
+        filename='lote12_filename', readonly=True,
+        states={
+            'invisible': Bool(Eval('archive_filename')),
+            })
     lote12_filename = fields.Char('Name')
     lote19_file = fields.Binary(
         '1.9. Retenciones Act. 6 de Bancos',
-        filename='lote19_filename', readonly=True)
+        filename='lote19_filename', readonly=True,
+        states={
+            'invisible': Bool(Eval('archive_filename')),
+            })
     lote19_filename = fields.Char('Name')
+    archive_file = fields.Binary('Archive',
+        filename='archive_filename', readonly=True,
+        states={
+            'invisible': ~Eval('archive_filename'),
+            })
+    archive_filename = fields.Char('Name')
+    percepcion_base = fields.Numeric('Percepción base', digits=(16, 2),
+        readonly=True)
+    percepcion_amount = fields.Numeric('Percepción amount', digits=(16, 2),
+        readonly=True)
+    retencion_base = fields.Numeric('Retención base', digits=(16, 2),
+        readonly=True)
+    retencion_amount = fields.Numeric('Retención amount', digits=(16, 2),
+        readonly=True)
     message = fields.Text('Message', readonly=True)
 
 
@@ -259,6 +493,12 @@ class ExportARBARN3811(Wizard):
     start = StateView('arba.rn3811.start',
         'account_arba.arba_rn3811_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Preview', 'preview', 'tryton-search'),
+            Button('Export', 'export', 'tryton-forward', default=True),
+            ])
+    preview = StateView('arba.rn3811.preview',
+        'account_arba.arba_rn3811_preview_view_form', [
+            Button('Back', 'start', 'tryton-back'),
             Button('Export', 'export', 'tryton-forward', default=True),
             ])
     export = StateTransition()
@@ -267,12 +507,208 @@ class ExportARBARN3811(Wizard):
             Button('Close', 'end', 'tryton-close', default=True),
             ])
 
+    _lote12_order = [
+        ('number', 'ASC'),
+        ('invoice_date', 'ASC'),
+        ]
+    _lote19_order = [
+        ('date', 'ASC'),
+        ('name', 'ASC'),
+        ]
+
+    def default_preview(self, fields):
+        return self.get_preview()
+
+    def get_preview(self):
+        """ Devuelve la cantidad de líneas, rechazos y totales de cada lote
+        calculados con consultas agregadas, sin generar los registros.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        Identifier = pool.get('party.identifier')
+        Invoice = pool.get('account.invoice')
+        InvoiceTax = pool.get('account.invoice.tax')
+        Move = pool.get('account.move')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        cursor = Transaction().connection.cursor()
+
+        company = Company(Transaction().context['company'])
+        arba_regimen_percepcion = company.arba_regimen_percepcion
+        arba_regimen_retencion = company.arba_regimen_retencion
+        start_date, end_date = self.start.start_date, self.start.end_date
+
+        def to_decimal(value):
+            return Decimal(str(value or 0))
+
+        values = {
+            'lote12_lines': 0,
+            'lote12_rejected_cuit': 0,
+            'lote12_base': Decimal(0),
+            'lote12_amount': Decimal(0),
+            'lote19_lines': 0,
+            'lote19_rejected_cuit': 0,
+            'lote19_rejected_base': 0,
+            'lote19_base': Decimal(0),
+            'lote19_amount': Decimal(0),
+            }
+        rows12, rows19 = [], []
+
+        # 1.2. Percepciones Act. 7 método Percibido (quincenal)
+        if arba_regimen_percepcion:
+            invoice = Invoice.__table__()
+            invoice_tax = InvoiceTax.__table__()
+            move = Move.__table__()
+            tax_amount = Sum(invoice_tax.amount)
+            invoices = (invoice
+                .join(move, condition=move.id == invoice.move)
+                .join(invoice_tax, condition=invoice_tax.invoice == invoice.id)
+                .select(
+                    invoice.id.as_('id'),
+                    invoice.party.as_('party'),
+                    invoice.untaxed_amount_cache.as_('base'),
+                    tax_amount.as_('amount'),
+                    where=(invoice.company == company.id)
+                    & (invoice.type == 'out')
+                    & (invoice.state.in_(['posted', 'paid'])
+                        | ((invoice.state == 'cancelled')
+                            & (invoice.number != Null)))
+                    & (move.date >= start_date)
+                    & (move.date <= end_date)
+                    & (invoice_tax.tax == arba_regimen_percepcion.id),
+                    group_by=[invoice.id, invoice.party,
+                        invoice.untaxed_amount_cache],
+                    having=tax_amount != 0))
+            cursor.execute(*invoices.select(
+                    invoices.party, Count(Literal('*')),
+                    Sum(invoices.base), Sum(invoices.amount),
+                    where=invoices.base != Null,
+                    group_by=[invoices.party]))
+            rows12 = cursor.fetchall()
+            # The export uses untaxed_amount which is computed from the
+            # lines when the cache is empty
+            cursor.execute(*invoices.select(
+                    invoices.id, invoices.party, invoices.amount,
+                    where=invoices.base == Null))
+            uncached = cursor.fetchall()
+            if uncached:
+                bases = Invoice.get_amount(
+                    Invoice.browse([r[0] for r in uncached]),
+                    ['untaxed_amount'])['untaxed_amount']
+                rows12.extend((party_id, 1, bases[invoice_id], amount)
+                    for invoice_id, party_id, amount in uncached)
+
+        # 1.9. Retenciones Act. 6 de Bancos
+        if arba_regimen_retencion:
+            retencion = TaxWithholdingSubmitted.__table__()
+            retenciones = retencion.select(
+                retencion.party.as_('party'),
+                Case((Coalesce(retencion.payment_amount, 0) != 0, 1),
+                    else_=0).as_('has_base'),
+                retencion.payment_amount.as_('base'),
+                retencion.amount.as_('amount'),
+                where=(retencion.tax == arba_regimen_retencion.id)
+                & (retencion.state == 'issued')
+                & (retencion.date >= start_date)
+                & (retencion.date <= end_date))
+            cursor.execute(*retenciones.select(
+                    retenciones.party, retenciones.has_base,
+                    Count(Literal('*')),
+                    Sum(retenciones.base), Sum(retenciones.amount),
+                    group_by=[retenciones.party, retenciones.has_base]))
+            rows19 = cursor.fetchall()
+
+        # Same CUIT as party.vat_number, the first ar_vat identifier
+        Cbte = ARBARN3811()
+        party_ids = {r[0] for r in rows12} | {r[0] for r in rows19}
+        identifier = Identifier.__table__()
+        vat_numbers = {}
+        for sub_ids in grouped_slice(party_ids):
+            cursor.execute(*identifier.select(
+                    identifier.party, identifier.code,
+                    where=(identifier.type == 'ar_vat')
+                    & identifier.party.in_(list(sub_ids)),
+                    order_by=[identifier.sequence.asc.nulls_first,
+                        identifier.id.asc]))
+            for party_id, code in cursor:
+                vat_numbers.setdefault(party_id, code)
+        valid_parties = {p for p, code in vat_numbers.items()
+            if Cbte._format_vat_number(code)}
+
+        for party_id, count, base, amount in rows12:
+            if party_id not in valid_parties:
+                values['lote12_rejected_cuit'] += count
+                continue
+            values['lote12_lines'] += count
+            values['lote12_base'] += to_decimal(base)
+            values['lote12_amount'] += to_decimal(amount)
+        for party_id, has_base, count, base, amount in rows19:
+            if party_id not in valid_parties:
+                values['lote19_rejected_cuit'] += count
+            elif not has_base:
+                values['lote19_rejected_base'] += count
+            else:
+                values['lote19_lines'] += count
+                values['lote19_base'] += to_decimal(base)
+                values['lote19_amount'] += to_decimal(amount)
+        return values
+
     def transition_export(self):
         """
         Action that exports the data into a formated text file.
         """
         pool = Pool()
         Company = pool.get('company.company')
+
+        company = Company(Transaction().context['company'])
+        company_vat_number = company.party.vat_number
+
+        lote12, lote19, message = self.get_lotes()
+        lote12_files = list(
+            self._get_lote_files(company_vat_number, '7', lote12))
+        lote19_files = list(
+            self._get_lote_files(company_vat_number, '6', lote19))
+        if self.start.single_archive:
+            self.result.archive_file = self.get_content(
+                lote12_files + lote19_files)
+            self.result.archive_filename = self._get_archive_filename(
+                company_vat_number)
+        else:
+            self.result.lote12_file = self.get_content(lote12_files)
+            self.result.lote12_filename = self._get_archive_filename(
+                company_vat_number, '7', lote12_files)
+            self.result.lote19_file = self.get_content(lote19_files)
+            self.result.lote19_filename = self._get_archive_filename(
+                company_vat_number, '6', lote19_files)
+        self.result.message = message
+
+        return 'result'
+
+    def get_files(self):
+        """ Devuelve la lista de archivos a generar (nombre, lotes) y el
+        mensaje con los comprobantes descartados.
+        Cada lote es una tupla (nombre del ZIP, nombre, contenido) por
+        período, y se escriben con write_files.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        company = Company(Transaction().context['company'])
+        company_vat_number = company.party.vat_number
+
+        lote12, lote19, message = self.get_lotes()
+        files = list(self._get_lote_files(company_vat_number, '7', lote12))
+        files.extend(self._get_lote_files(company_vat_number, '6', lote19))
+        if self.start.single_archive:
+            return [(self._get_archive_filename(company_vat_number),
+                    files)], message
+        return [(f[0], [f]) for f in files], message
+
+    def get_lotes(self):
+        """ Devuelve los registros de los lotes 1.2 y 1.9 agrupados por
+        período y el mensaje con los comprobantes descartados.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
         Invoice = pool.get('account.invoice')
         TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
 
@@ -280,53 +716,181 @@ class ExportARBARN3811(Wizard):
         arba_regimen_percepcion = company.arba_regimen_percepcion
         arba_regimen_retencion = company.arba_regimen_retencion
 
-        self.result.message = ''
+        messages = []
+        periods = self._get_periods()
+        exported_invoices, exported_retenciones = [], []
 
         # 1.2. Percepciones Act. 7 método Percibido (quincenal)
-        file_contents_lote12 = ''
-        invoices = Invoice.search([
-            ('type', '=', 'out'),
-            ['OR', ('state', 'in', ['posted', 'paid']),
-                [('state', '=', 'cancelled'), ('number', '!=', None)]],
-            ('move.date', '>=', self.start.start_date),
-            ('move.date', '<=', self.start.end_date),
-            #('pos.pos_do_not_report', '=', False),
-            ], order=[
-            ('number', 'ASC'),
-            ('invoice_date', 'ASC'),
-            ])
+        lote12 = {period: [] for period in periods}
+        invoices = Invoice.search(
+            self._get_lote12_domain(company,
+                self.start.start_date, self.start.end_date),
+            order=self._lote12_order)
         for invoice in invoices:
             aux_record, add_line, message = self._get_formated_record_lote12(
                 invoice, arba_regimen_percepcion)
             if add_line:
-                file_contents_lote12 += aux_record
+                lote12[self._get_period(invoice.move.date)].append(aux_record)
+                exported_invoices.append(invoice)
             if message:
-                self.result.message += message + '\n'
-        self.result.lote12_file = str(
-            file_contents_lote12).encode('utf-8')
+                messages.append(message)
 
         # 1.9. Retenciones Act. 6 de Bancos
-        file_contents_lote19 = ''
-        retenciones = TaxWithholdingSubmitted.search([
-            ('tax', '=', arba_regimen_retencion),
-            ('date', '>=', self.start.start_date),
-            ('date', '<=', self.start.end_date),
-            ('state', '=', 'issued'),
-            ], order=[
-            ('date', 'ASC'),
-            ('name', 'ASC'),
-            ])
+        lote19 = {period: [] for period in periods}
+        retenciones = TaxWithholdingSubmitted.search(
+            self._get_lote19_domain(arba_regimen_retencion,
+                self.start.start_date, self.start.end_date),
+            order=self._lote19_order)
         for retencion in retenciones:
             aux_record, add_line, message = self._get_formated_record_lote19(
                 retencion)
             if add_line:
-                file_contents_lote19 += aux_record
+                lote19[self._get_period(retencion.date)].append(aux_record)
+                exported_retenciones.append(retencion)
             if message:
-                self.result.message += message + '\n'
-        self.result.lote19_file = str(
-            file_contents_lote19).encode('utf-8')
+                messages.append(message)
 
-        return 'result'
+        messages.extend(self._check_period_totals(
+                company, exported_invoices, exported_retenciones))
+        message = ''.join(m + '\n' for m in messages)
+        return lote12, lote19, message
+
+    def _has_period_totals(self):
+        """ Las fechas coinciden con inicio y fin de quincena. """
+        pool = Pool()
+        PeriodTotal = pool.get('arba.period.total')
+        start_date = self.start.start_date
+        next_date = self.start.end_date + datetime.timedelta(days=1)
+        return (PeriodTotal._get_period_date(start_date) == start_date
+            and PeriodTotal._get_period_date(next_date) == next_date)
+
+    def _check_period_totals(self, company, invoices, retenciones):
+        """ Compara los totales del archivo con los totales por período
+        y devuelve los mensajes de las diferencias.
+        """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        PeriodTotal = pool.get('arba.period.total')
+
+        if not self._has_period_totals():
+            return []
+        file_totals = [Decimal(0)] * 4
+        for company_id, _, *amounts in (
+                Invoice._get_arba_period_totals(invoices)
+                + TaxWithholdingSubmitted._get_arba_period_totals(
+                    retenciones)):
+            if company_id == company.id:
+                file_totals = [t + a for t, a in zip(file_totals, amounts)]
+        period_totals = PeriodTotal.get_totals(
+            company, self.start.start_date, self.start.end_date)
+
+        messages = []
+        names = ['Base percepciones', 'Importe percepciones',
+            'Base retenciones', 'Importe retenciones']
+        for name, file_total, period_total in zip(
+                names, file_totals, period_totals):
+            if file_total != period_total:
+                messages.append('ADVERTENCIA: %s del archivo (%s) no '
+                    'coincide con el total del período (%s).'
+                    % (name, file_total, period_total))
+        return messages
+
+    @classmethod
+    def _get_lote12_domain(cls, company, start_date, end_date):
+        return [
+            ('company', '=', company),
+            ('type', '=', 'out'),
+            ['OR', ('state', 'in', ['posted', 'paid']),
+                [('state', '=', 'cancelled'), ('number', '!=', None)]],
+            ('move.date', '>=', start_date),
+            ('move.date', '<=', end_date),
+            #('pos.pos_do_not_report', '=', False),
+            ]
+
+    @classmethod
+    def _get_lote19_domain(cls, arba_regimen_retencion, start_date, end_date):
+        return [
+            ('tax', '=', arba_regimen_retencion),
+            ('date', '>=', start_date),
+            ('date', '<=', end_date),
+            ('state', '=', 'issued'),
+            ]
+
+    def _get_period(self, date):
+        """ Período ARBA (AAAAMMQ) al que corresponde la fecha.
+        Q es 0 para períodos mensuales y 1 o 2 para quincenales.
+        """
+        if not self.start.split_periods:
+            return self.start.start_date.strftime('%Y%m') + '0'
+        if self.start.period_type == 'fortnight':
+            return date.strftime('%Y%m') + ('1' if date.day <= 15 else '2')
+        return date.strftime('%Y%m') + '0'
+
+    def _get_periods(self):
+        """ Períodos ARBA comprendidos entre las fechas desde y hasta. """
+        periods = []
+        date = self.start.start_date
+        while date <= self.start.end_date:
+            period = self._get_period(date)
+            if period not in periods:
+                periods.append(period)
+            date += datetime.timedelta(days=1)
+        return periods or [self._get_period(self.start.start_date)]
+
+    def _get_lote_files(self, company_vat_number, activity, lote):
+        """ Genera (nombre del ZIP, nombre, contenido) por cada período del
+        lote.
+        """
+        ext = 'CSV' if self.start.csv_format else 'TXT'
+        for period, records in lote.items():
+            filename = 'AR-%s-%s-%s-%s' % (
+                company_vat_number, period, activity, period)
+            yield ('%s.ZIP' % filename, '%s.%s' % (filename, ext),
+                ''.join(records).encode('utf-8'))
+
+    def _get_archive_filename(self, company_vat_number, activity=None,
+            files=None):
+        if files and len(files) == 1:
+            (zip_filename, _, _), = files
+            return zip_filename
+        periods = self._get_periods()
+        if activity:
+            return 'AR-%s-%s-%s-%s.ZIP' % (
+                company_vat_number, periods[0], activity, periods[-1])
+        return 'AR-%s-%s-%s.ZIP' % (
+            company_vat_number, periods[0], periods[-1])
+
+    @classmethod
+    def get_content(cls, files):
+        content = BytesIO()
+        cls.write_files(content, files)
+        return content.getvalue()
+
+    @classmethod
+    def write_files(cls, file_, files):
+        """ Escribe en file_ el ZIP del lote si hay uno solo, sino un ZIP
+        sin comprimir que contiene el ZIP de cada lote y período.
+        """
+        if len(files) == 1:
+            (_, filename, data), = files
+            cls._write_zip(file_, filename, data)
+            return
+        with zipfile.ZipFile(file_, 'w') as archive:
+            for zip_filename, filename, data in files:
+                with archive.open(zip_filename, 'w') as lote_file:
+                    cls._write_zip(lote_file, filename, data)
+
+    @classmethod
+    def _write_zip(cls, file_, filename, data):
+        compression = config.get(
+            'account_arba', 'zip_compression', default='deflated')
+        compresslevel = config.getint(
+            'account_arba', 'zip_compresslevel', default=None)
+        with zipfile.ZipFile(file_, 'w',
+                compression=ZIP_COMPRESSIONS[compression],
+                compresslevel=compresslevel) as lote_zip:
+            lote_zip.writestr(filename, data)
 
     def _get_formated_record_lote12(self, invoice, arba_regimen_percepcion):
         """ RN Nº 3811
@@ -474,44 +1038,28 @@ class ExportARBARN3811(Wizard):
         return (Cbte.a_text(self.start.csv_format), True, '')
 
     def default_result(self, fields):
-        pool = Pool()
-        Company = pool.get('company.company')
-
-        company = Company(Transaction().context['company'])
-        company_vat_number = company.party.vat_number
-        period = self.start.start_date.strftime('%Y%m') + '0'
-        ext = 'CSV' if self.start.csv_format else 'TXT'
-
-        lote12_filename = 'AR-%s-%s-%s-%s' % (
-            company_vat_number, period, '7', period)
-        lote12_content = BytesIO()
-        with zipfile.ZipFile(lote12_content, 'w') as lote12_content_zip:
-            lote12_content_zip.writestr('%s.%s' % (lote12_filename, ext),
-                self.result.lote12_file)
-        lote12_content = lote12_content.getvalue()
-        lote12_file = (bytearray(lote12_content) if bytes == str
-            else bytes(lote12_content))
-
-        lote19_filename = 'AR-%s-%s-%s-%s' % (
-            company_vat_number, period, '6', period)
-        lote19_content = BytesIO()
-        with zipfile.ZipFile(lote19_content, 'w') as lote19_content_zip:
-            lote19_content_zip.writestr('%s.%s' % (lote19_filename, ext),
-                self.result.lote19_file)
-        lote19_content = lote19_content.getvalue()
-        lote19_file = (bytearray(lote19_content) if bytes == str
-            else bytes(lote19_content))
-
-        message = self.result.message
+        values = {
+            'lote12_file': self.result.lote12_file,
+            'lote12_filename': self.result.lote12_filename,
+            'lote19_file': self.result.lote19_file,
+            'lote19_filename': self.result.lote19_filename,
+            'archive_file': self.result.archive_file,
+            'archive_filename': self.result.archive_filename,
+            'message': self.result.message,
+            }
+        if self._has_period_totals():
+            pool = Pool()
+            Company = pool.get('company.company')
+            PeriodTotal = pool.get('arba.period.total')
+            company = Company(Transaction().context['company'])
+            (values['percepcion_base'], values['percepcion_amount'],
+                values['retencion_base'], values['retencion_amount']) = (
+                PeriodTotal.get_totals(company,
+                    self.start.start_date, self.start.end_date))
 
         self.result.lote12_file = None
         self.result.lote19_file = None
+        self.result.archive_file = None
         self.result.message = None
 
-        return {
-            'lote12_file': lote12_file,
-            'lote12_filename': '%s.ZIP' % lote12_filename,
-            'lote19_file': lote19_file,
-            'lote19_filename': '%ss.ZIP' % lote19_filename,
-            'message': message,
-            }
+        return values
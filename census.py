@@ -0,0 +1,234 @@
+# This file is part of the account_arba module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import zipfile
+from decimal import Decimal
+from io import BytesIO
+
+from sql import Null
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import fields, Index, ModelSQL, ModelView
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+import logging
+logger = logging.getLogger(__name__)
+
+CENSUS_TYPES = [
+    ('percepcion', 'Percepción'),
+    ('retencion', 'Retención'),
+    ]
+# Régimen column of the census file
+CENSUS_REGIMENES = {
+    'percepcion': 'P',
+    'retencion': 'R',
+    }
+
+
+class ARBACensus(ModelSQL, ModelView):
+    'ARBA Census'
+    __name__ = 'arba.census'
+
+    type = fields.Selection(CENSUS_TYPES, 'Type', required=True,
+        readonly=True)
+    vat_number = fields.Char('CUIT', required=True, readonly=True)
+    start_date = fields.Date('Start date', readonly=True)
+    end_date = fields.Date('End date', readonly=True)
+    rate = fields.Numeric('Rate', digits=(14, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.vat_number, Index.Equality()),
+                (t.type, Index.Equality())))
+        cls._order.insert(0, ('vat_number', 'ASC'))
+
+    @classmethod
+    def get_rates(cls, vat_numbers, date=None):
+        """ Devuelve un diccionario CUIT: (alícuota percepción,
+        alícuota retención) con el padrón vigente a la fecha.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if date is None:
+            date = Date.today()
+        rates = {}
+        for sub_vat_numbers in grouped_slice(set(vat_numbers)):
+            cursor.execute(*table.select(
+                    table.vat_number, table.type, table.rate,
+                    where=table.vat_number.in_(list(sub_vat_numbers))
+                    & ((table.start_date == Null)
+                        | (table.start_date <= date))
+                    & ((table.end_date == Null)
+                        | (table.end_date >= date))))
+            for vat_number, type_, rate in cursor:
+                rate_percepcion, rate_retencion = rates.get(
+                    vat_number, (None, None))
+                if type_ == 'percepcion':
+                    rate_percepcion = rate
+                else:
+                    rate_retencion = rate
+                rates[vat_number] = (rate_percepcion, rate_retencion)
+        return rates
+
+    @classmethod
+    def import_census(cls, type_, data):
+        """ Reemplaza el padrón del tipo indicado por el contenido de un
+        archivo de padrón de ARBA (texto o ZIP).
+        """
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        cursor.execute(*table.delete(where=table.type == type_))
+        columns = [table.create_uid, table.create_date, table.type,
+            table.vat_number, table.start_date, table.end_date, table.rate]
+        count = 0
+        for sub_records in grouped_slice(cls._parse_census(type_, data)):
+            values = [
+                [transaction.user, CurrentTimestamp(), type_]
+                + list(record) for record in sub_records]
+            cursor.execute(*table.insert(columns, values))
+            count += len(values)
+        logger.info('ARBA Census %s: %s records imported' % (type_, count))
+        return count
+
+    @classmethod
+    def _parse_census(cls, type_, data):
+        """ Formato del padrón de ARBA (una línea por contribuyente):
+        Régimen;Fecha publicación;Fecha desde;Fecha hasta;CUIT;
+        Tipo contribuyente;Marca alta;Marca alícuota;Alícuota;Grupo
+        El régimen (P o R) debe coincidir con el tipo de padrón.
+        """
+        def parse_date(value):
+            return datetime.datetime.strptime(value, '%d%m%Y').date()
+
+        if data[:2] == b'PK':
+            with zipfile.ZipFile(BytesIO(data)) as archive:
+                data = archive.read(archive.namelist()[0])
+        for number, line in enumerate(
+                data.decode('iso-8859-1').splitlines(), 1):
+            values = line.strip().split(';')
+            if len(values) < 9:
+                continue
+            if values[0].strip().upper() != CENSUS_REGIMENES[type_]:
+                raise UserError(gettext(
+                        'account_arba.msg_census_type_mismatch',
+                        line=number,
+                        regimen=values[0],
+                        type=dict(CENSUS_TYPES)[type_]))
+            yield (values[4], parse_date(values[2]), parse_date(values[3]),
+                Decimal(values[8].replace(',', '.')))
+
+
+class ARBACensusJob(ModelSQL, ModelView):
+    'ARBA Census Job'
+    __name__ = 'arba.census.job'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    state = fields.Selection([
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', readonly=True, sort=False)
+    total = fields.Integer('Total', readonly=True)
+    processed = fields.Integer('Processed', readonly=True)
+    failed = fields.Integer('Failed', readonly=True)
+    progress = fields.Function(
+        fields.Float('Progress', digits=(1, 4)), 'get_progress')
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_state():
+        return 'running'
+
+    @staticmethod
+    def default_processed():
+        return 0
+
+    @staticmethod
+    def default_failed():
+        return 0
+
+    def get_progress(self, name):
+        if not self.total:
+            return 1.
+        return min(
+            ((self.processed or 0) + (self.failed or 0)) / self.total, 1.)
+
+    @classmethod
+    def add_processed(cls, job_id, count, error=None):
+        """ Suma count partes procesadas al job, o fallidas si hay error.
+        Los chunks se ejecutan en paralelo, por eso se actualiza con SQL.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if error is None:
+            columns = [table.processed]
+            values = [table.processed + count]
+        else:
+            columns = [table.failed, table.error]
+            values = [Coalesce(table.failed, 0) + count, error]
+        cursor.execute(*table.update(
+                columns + [table.write_date],
+                values + [CurrentTimestamp()],
+                where=table.id == job_id))
+        cursor.execute(*table.update(
+                [table.state],
+                [Case((Coalesce(table.failed, 0) > 0, 'failed'),
+                        else_='done')],
+                where=(table.id == job_id)
+                & (table.processed + Coalesce(table.failed, 0)
+                    >= table.total)))
+
+
+class ImportARBACensusStart(ModelView):
+    'Import ARBA Census'
+    __name__ = 'arba.census.import.start'
+
+    type = fields.Selection(CENSUS_TYPES, 'Type', required=True)
+    file_ = fields.Binary('File', required=True,
+        help='Padrón de percepciones o retenciones publicado por ARBA '
+        '(TXT o ZIP).')
+
+
+class ImportARBACensus(Wizard):
+    'Import ARBA Census'
+    __name__ = 'arba.census.import'
+
+    start = StateView('arba.census.import.start',
+        'account_arba.arba_census_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+
+    def transition_import_(self):
+        pool = Pool()
+        Census = pool.get('arba.census')
+        Census.import_census(self.start.type, self.start.file_)
+        return 'end'
@@ -1,9 +1,15 @@
 # This file is part of the account_arba module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import os
 
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import PoolMeta, Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class Company(metaclass=PoolMeta):
@@ -25,6 +31,99 @@ class Company(metaclass=PoolMeta):
             ('group.kind', '=', 'sale'),
             ])
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__.update({
+                'export_arba_rn3811': RPC(
+                    readonly=False, instantiate=0,
+                    result=lambda r: list(map(int, r))),
+                })
+
     @staticmethod
     def default_arba_mode_cert():
         return None
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Party = pool.get('party.party')
+        actions = iter(args)
+        clear_cache = False
+        for companies, values in zip(actions, actions):
+            if values.keys() & {
+                    'arba_regimen_retencion', 'arba_regimen_percepcion'}:
+                clear_cache = True
+        super().write(*args)
+        if clear_cache:
+            Party._arba_rates_cache.clear()
+
+    @classmethod
+    def export_arba_rn3811(cls, companies, start_date, end_date,
+            csv_format=False, split_periods=False, period_type='month',
+            single_archive=False):
+        """ Exporta los lotes ARBA RN Nº 38/11 de las empresas como
+        adjuntos y los devuelve.
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+        attachments = []
+        for company in companies:
+            files = company._get_arba_rn3811_files(start_date, end_date,
+                csv_format, split_periods, period_type, single_archive)
+            for filename, lotes in files:
+                attachments.append(Attachment(
+                        resource=company,
+                        name=filename,
+                        type='data',
+                        data=ExportARBARN3811.get_content(lotes),
+                        ))
+        Attachment.save(attachments)
+        return attachments
+
+    @classmethod
+    def export_arba_rn3811_files(cls, companies, path, start_date, end_date,
+            csv_format=False, split_periods=False, period_type='month',
+            single_archive=False):
+        """ Escribe los lotes ARBA RN Nº 38/11 de las empresas en el
+        directorio path y devuelve la lista de archivos escritos.
+        """
+        pool = Pool()
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+        filenames = []
+        os.makedirs(path, exist_ok=True)
+        for company in companies:
+            files = company._get_arba_rn3811_files(start_date, end_date,
+                csv_format, split_periods, period_type, single_archive)
+            for filename, lotes in files:
+                filename = os.path.join(path, filename)
+                with open(filename, 'wb') as file_:
+                    ExportARBARN3811.write_files(file_, lotes)
+                filenames.append(filename)
+        return filenames
+
+    def _get_arba_rn3811_files(self, start_date, end_date,
+            csv_format=False, split_periods=False, period_type='month',
+            single_archive=False):
+        pool = Pool()
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+        with Transaction().set_context(company=self.id):
+            session_id, _, _ = ExportARBARN3811.create()
+            try:
+                export = ExportARBARN3811(session_id)
+                export.start.start_date = start_date
+                export.start.end_date = end_date
+                export.start.csv_format = csv_format
+                export.start.split_periods = split_periods
+                export.start.period_type = period_type
+                export.start.single_archive = single_archive
+                files, message = export.get_files()
+            finally:
+                ExportARBARN3811.delete(session_id)
+        for line in message.splitlines():
+            logger.warning('%s: %s', self.rec_name, line)
+        return files
@@ -2,14 +2,17 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import logging
-from pyafipws.iibb import IIBB as WSIIBB
 from calendar import monthrange
 from decimal import Decimal
 
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.model import ModelView
 from trytond.pool import PoolMeta, Pool
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
-from trytond.exceptions import UserError
+from trytond.exceptions import UserError, TransactionError
 from trytond.i18n import gettext
 
 logger = logging.getLogger(__name__)
@@ -17,6 +20,7 @@ logger = logging.getLogger(__name__)
 
 class Party(metaclass=PoolMeta):
     __name__ = 'party.party'
+    _arba_rates_cache = Cache('party.party.arba_rates', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -25,27 +29,204 @@ class Party(metaclass=PoolMeta):
             'get_arba_data': {},
             })
 
+    @classmethod
+    def create(cls, vlist):
+        parties = super().create(vlist)
+        cls.set_arba_census_rates(parties)
+        return parties
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        to_update = []
+        for parties, values in zip(actions, actions):
+            if values.keys() & {'vat_number', 'identifiers'}:
+                to_update.extend(parties)
+        super().write(*args)
+        if to_update:
+            cls.set_arba_census_rates(to_update, clear=True)
+
     @classmethod
     @ModelView.button
     def get_arba_data(cls, parties):
-        cls.import_arba_census(parties)
+        pool = Pool()
+        Job = pool.get('arba.census.job')
+
+        chunk = config.getint('account_arba', 'census_chunk', default=100)
+        if len(parties) <= chunk:
+            cls.import_arba_census(parties)
+            return
+
+        company = Transaction().context.get('company')
+        if not company:
+            raise UserError(gettext(
+                'party_ar.msg_company_not_defined'))
+        job = Job(company=company, total=len(parties))
+        job.save()
+        for sub_parties in grouped_slice(parties, count=chunk):
+            cls.__queue__.import_arba_census_job(list(sub_parties), job.id)
+
+    @classmethod
+    def import_arba_census_job(cls, parties, job_id):
+        pool = Pool()
+        Job = pool.get('arba.census.job')
+        transaction = Transaction()
+        try:
+            imported = cls.import_arba_census(parties)
+        except (backend.DatabaseOperationalError, TransactionError):
+            # The worker retries the task
+            raise
+        except Exception as exception:
+            # Keep the failure on the job, the task transaction is lost
+            transaction.rollback()
+            Job.add_processed(job_id, len(parties), error=str(exception))
+            transaction.commit()
+            raise
+        if imported:
+            Job.add_processed(job_id, len(parties))
+        else:
+            Job.add_processed(job_id, len(parties), error=gettext(
+                    'account_arba.msg_census_job_not_configured'))
+
+    @classmethod
+    def get_arba_rates(cls, parties, company=None):
+        """ Devuelve un diccionario party id: (alícuota percepción,
+        alícuota retención) de los regímenes ARBA de la empresa.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        PartyWithholdingIIBB = pool.get('party.retencion.iibb')
+
+        if company is None:
+            company = Company(Transaction().context['company'])
+        arba_regimen_retencion = company.arba_regimen_retencion
+        arba_regimen_percepcion = company.arba_regimen_percepcion
+
+        rates, missing = {}, []
+        for party in parties:
+            value = cls._arba_rates_cache.get((company.id, party.id))
+            if value is not None:
+                rates[party.id] = tuple(value)
+            else:
+                missing.append(party.id)
+        if not missing:
+            return rates
+        if not arba_regimen_retencion and not arba_regimen_percepcion:
+            rates.update((p, (None, None)) for p in missing)
+            return rates
+
+        for sub_ids in grouped_slice(missing):
+            sub_ids = list(sub_ids)
+            clause = [('party', 'in', sub_ids)]
+            if arba_regimen_retencion:
+                clause.append(
+                    ('regimen_retencion', '=', arba_regimen_retencion))
+            if arba_regimen_percepcion:
+                clause.append(
+                    ('regimen_percepcion', '=', arba_regimen_percepcion))
+            found = {}
+            for arba_regimen in PartyWithholdingIIBB.search(clause):
+                found.setdefault(arba_regimen.party.id, (
+                        arba_regimen.rate_percepcion,
+                        arba_regimen.rate_retencion))
+            for party_id in sub_ids:
+                rates[party_id] = found.get(party_id, (None, None))
+                cls._arba_rates_cache.set(
+                    (company.id, party_id), rates[party_id])
+        return rates
+
+    @classmethod
+    def set_arba_census_rates(cls, parties, clear=False):
+        """ Asigna las alícuotas del padrón de ARBA cargado localmente.
+        Con clear, quita las alícuotas que el padrón no informa para el
+        CUIT actual del tercero.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        Census = pool.get('arba.census')
+
+        company_id = Transaction().context.get('company')
+        if not company_id:
+            return
+        company = Company(company_id)
+        if (not company.arba_regimen_retencion
+                and not company.arba_regimen_percepcion):
+            return
+
+        if not clear:
+            parties = [p for p in parties if p.vat_number]
+        if not parties:
+            return
+        census = Census.get_rates(
+            p.vat_number for p in parties if p.vat_number)
+        rates = {}
+        for party in parties:
+            if party.vat_number in census:
+                rates[party] = census[party.vat_number]
+            elif clear:
+                rates[party] = (None, None)
+        cls._set_arba_rates(company, rates, clear=clear)
+
+    @classmethod
+    def _set_arba_rates(cls, company, rates, clear=False):
+        """ Actualiza party.retencion.iibb con un diccionario
+        party: (alícuota percepción, alícuota retención).
+        Sin clear, las alícuotas None no modifican las existentes.
+        """
+        pool = Pool()
+        PartyWithholdingIIBB = pool.get('party.retencion.iibb')
+
+        arba_regimen_retencion = company.arba_regimen_retencion
+        arba_regimen_percepcion = company.arba_regimen_percepcion
+
+        iibb_regimenes = {}
+        for sub_parties in grouped_slice(list(rates.keys())):
+            clause = [('party', 'in', [p.id for p in sub_parties])]
+            if arba_regimen_retencion:
+                clause.append(
+                    ('regimen_retencion', '=', arba_regimen_retencion))
+            if arba_regimen_percepcion:
+                clause.append(
+                    ('regimen_percepcion', '=', arba_regimen_percepcion))
+            for arba_regimen in PartyWithholdingIIBB.search(clause):
+                iibb_regimenes.setdefault(arba_regimen.party, arba_regimen)
+
+        to_save = []
+        for party, (rate_percepcion, rate_retencion) in rates.items():
+            arba_regimen = iibb_regimenes.get(party)
+            if not arba_regimen:
+                if rate_percepcion is None and rate_retencion is None:
+                    continue
+                arba_regimen = PartyWithholdingIIBB(
+                    party=party,
+                    regimen_retencion=arba_regimen_retencion,
+                    regimen_percepcion=arba_regimen_percepcion,
+                    )
+            if clear or rate_percepcion is not None:
+                arba_regimen.rate_percepcion = rate_percepcion
+            if clear or rate_retencion is not None:
+                arba_regimen.rate_retencion = rate_retencion
+            to_save.append(arba_regimen)
+        PartyWithholdingIIBB.save(to_save)
 
     @classmethod
     def import_arba_census(cls, parties):
+        """ Consulta las alícuotas de los terceros en el web service de
+        ARBA. Devuelve False si no está configurado.
+        """
         pool = Pool()
         Date = pool.get('ir.date')
         Company = pool.get('company.company')
-        PartyWithholdingIIBB = pool.get('party.retencion.iibb')
 
         ws = cls.get_ws_arba()
         if not ws:
-            return
+            return False
 
         company = Company(Transaction().context['company'])
         arba_regimen_retencion = company.arba_regimen_retencion
         arba_regimen_percepcion = company.arba_regimen_percepcion
         if not arba_regimen_retencion and not arba_regimen_percepcion:
-            return
+            return False
 
         today = Date.today()
         _, end_date = monthrange(today.year, today.month)
@@ -62,35 +243,25 @@ class Party(metaclass=PoolMeta):
             if data is None:
                 continue
 
-            clause = [('party', '=', party)]
-            if arba_regimen_retencion:
-                clause.append(('regimen_retencion', '=', arba_regimen_retencion))
-            if arba_regimen_percepcion:
-                clause.append(('regimen_percepcion', '=', arba_regimen_percepcion))
-            iibb_regimenes = PartyWithholdingIIBB.search(clause)
-            if iibb_regimenes:
-                arba_regimen = iibb_regimenes[0]
-            else:
-                arba_regimen = PartyWithholdingIIBB(
-                    party=party,
-                    regimen_retencion=arba_regimen_retencion,
-                    regimen_percepcion=arba_regimen_percepcion,
-                    )
             iibb_rate_percepcion = data.AlicuotaPercepcion
             iibb_rate_retencion = data.AlicuotaRetencion
             logger.info('Party: %s | Percepción: %s | Retención: %s' %
                 (party.vat_number, iibb_rate_percepcion, iibb_rate_retencion))
+            rate_percepcion = rate_retencion = None
             if iibb_rate_percepcion != '':
-                arba_regimen.rate_percepcion = Decimal(
+                rate_percepcion = Decimal(
                     iibb_rate_percepcion.replace(',', '.'))
             if iibb_rate_retencion != '':
-                arba_regimen.rate_retencion = Decimal(
+                rate_retencion = Decimal(
                     iibb_rate_retencion.replace(',', '.'))
-            arba_regimen.save()
+            cls._set_arba_rates(company,
+                {party: (rate_percepcion, rate_retencion)})
             Transaction().commit()
+        return True
 
     @classmethod
     def get_ws_arba(cls):
+        from pyafipws.iibb import IIBB as WSIIBB
         pool = Pool()
         Company = pool.get('company.company')
         if Transaction().context.get('company'):
@@ -133,6 +304,32 @@ class Party(metaclass=PoolMeta):
         logger.info('Import ARBA Census::End')
 
 
+class PartyWithholdingIIBB(metaclass=PoolMeta):
+    __name__ = 'party.retencion.iibb'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Party = pool.get('party.party')
+        records = super().create(vlist)
+        Party._arba_rates_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Party = pool.get('party.party')
+        super().write(*args)
+        Party._arba_rates_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Party = pool.get('party.party')
+        super().delete(records)
+        Party._arba_rates_cache.clear()
+
+
 class Cron(metaclass=PoolMeta):
     __name__ = 'ir.cron'
 
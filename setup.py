@@ -94,6 +94,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         'trytond.modules.%s' % MODULE: (info.get('xml', []) + [
             'tryton.cfg', 'view/*.xml', 'locale/*.po']),
         },
+    scripts=['scripts/trytond-arba-rn3811'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Plugins',
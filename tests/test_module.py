@@ -1,13 +1,1135 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import subprocess
+import sys
+import unittest
+import tempfile
+import zipfile
+from decimal import Decimal
+from io import BytesIO
+from unittest.mock import patch
+
+from sql import Null
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import Index
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+IMPORT_CODE = '''
+import json, resource, sys, time
+import trytond.model, trytond.wizard
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import trytond.modules.account_arba
+print(json.dumps({
+    'time': time.perf_counter() - start,
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    'modules': [m for m in ['pyafipws.iibb', 'stdnum.ar.cuit']
+        if m in sys.modules],
+    }))
+'''
+logger = logging.getLogger(__name__)
+SCRIPT = os.path.join(
+    os.path.dirname(__file__), '..', 'scripts', 'trytond-arba-rn3811')
+
+
+def create_party(name, vat_number=None):
+    pool = Pool()
+    Party = pool.get('party.party')
+
+    values = {
+        'name': name,
+        'addresses': [('create', [{}])],
+        }
+    if vat_number:
+        values['iva_condition'] = 'responsable_inscripto'
+        values['identifiers'] = [('create', [{
+                        'type': 'ar_vat',
+                        'code': vat_number,
+                        }])]
+    else:
+        values['iva_condition'] = 'consumidor_final'
+    party, = Party.create([values])
+    return party
+
+
+def set_vat_number(party, vat_number):
+    pool = Pool()
+    Party = pool.get('party.party')
+
+    Party.write([party], {
+            'identifiers': [
+                ('delete', [i.id for i in party.identifiers]),
+                ('create', [{
+                            'type': 'ar_vat',
+                            'code': vat_number,
+                            }]),
+                ],
+            })
+
+
+def create_arba_company(name='Dunder Mifflin', vat_number='30710158254',
+        currency=None):
+    company = create_company(name, currency=currency)
+    set_vat_number(company.party, vat_number)
+    company.party.iva_condition = 'responsable_inscripto'
+    company.party.save()
+    return company
+
+
+def get_account(company, name):
+    pool = Pool()
+    Account = pool.get('account.account')
+
+    account, = Account.search([
+            ('company', '=', company.id),
+            ('name', '=', name),
+            ])
+    return account
+
+
+def set_arba_regimenes(company):
+    "Create the chart of accounts and the ARBA regimenes of the company"
+    pool = Pool()
+    Company = pool.get('company.company')
+    TaxGroup = pool.get('account.tax.group')
+    Tax = pool.get('account.tax')
+    Retencion = pool.get('account.retencion')
+
+    create_chart(company)
+    tax_account = get_account(company, 'Main Tax')
+    group = TaxGroup(name='IIBB', code='IIBB', kind='sale',
+        afip_kind='provincial')
+    group.save()
+    percepcion = Tax(name='Percepción IIBB ARBA',
+        description='Percepción IIBB ARBA', type='percentage',
+        rate=Decimal('.03'), group=group, company=company,
+        invoice_account=tax_account, credit_note_account=tax_account)
+    percepcion.save()
+    retencion = Retencion(name='Retención IIBB ARBA', type='efectuada',
+        tax='iibb', account=tax_account)
+    retencion.save()
+    Company.write([company], {
+            'arba_regimen_percepcion': percepcion.id,
+            'arba_regimen_retencion': retencion.id,
+            })
+    return percepcion, retencion
+
+
+def create_fiscalyear(company, date):
+    pool = Pool()
+    FiscalYear = pool.get('account.fiscalyear')
+
+    fiscalyear = set_invoice_sequences(get_fiscalyear(company, today=date))
+    fiscalyear.save()
+    FiscalYear.create_period([fiscalyear])
+    return fiscalyear
+
+
+def create_invoice_type(company):
+    "Return the Factura A sequence of a manual point of sale"
+    pool = Pool()
+    Pos = pool.get('account.pos')
+    PosSequence = pool.get('account.pos.sequence')
+    Sequence = pool.get('ir.sequence.strict')
+    SequenceType = pool.get('ir.sequence.type')
+
+    sequence_type, = SequenceType.search([
+            ('name', '=', "Invoice"),
+            ], limit=1)
+    sequence = Sequence(name='Factura A', sequence_type=sequence_type,
+        company=company)
+    sequence.save()
+    pos = Pos(company=company, number=1, pos_type='manual')
+    pos.save()
+    invoice_type = PosSequence(pos=pos, invoice_type='1',
+        invoice_sequence=sequence)
+    invoice_type.save()
+    return invoice_type
+
+
+def create_invoice(invoice_type, party, date, amount, taxes, post=True):
+    "Create a customer invoice of amount with the taxes"
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    InvoiceLine = pool.get('account.invoice.line')
+    Journal = pool.get('account.journal')
+
+    company = invoice_type.pos.company
+    journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+    invoice = Invoice(company=company, type='out', party=party,
+        invoice_address=party.addresses[0], currency=company.currency,
+        account=get_account(company, 'Main Receivable'), journal=journal,
+        invoice_date=date, pos=invoice_type.pos, invoice_type=invoice_type)
+    invoice.lines = [InvoiceLine(company=company, type='line',
+            currency=company.currency,
+            account=get_account(company, 'Main Revenue'),
+            description='Test', quantity=1, unit_price=amount,
+            taxes=taxes)]
+    invoice.save()
+    if post:
+        Invoice.post([invoice])
+    return invoice
+
+
+def setup_arba_company(name, vat_number, date, currency=None):
+    "Return an ARBA company ready to invoice with its percepción tax"
+    company = create_arba_company(name, vat_number, currency=currency)
+    with set_company(company):
+        percepcion, retencion = set_arba_regimenes(company)
+        create_fiscalyear(company, date)
+        invoice_type = create_invoice_type(company)
+    return company, invoice_type, percepcion, retencion
+
+
+def read_period_totals(company):
+    "Return the ARBA period totals of the company by date"
+    pool = Pool()
+    PeriodTotal = pool.get('arba.period.total')
+
+    return {t['date']: (
+            t['percepcion_base'], t['percepcion_amount'],
+            t['retencion_base'], t['retencion_amount'])
+        for t in PeriodTotal.search_read([
+                ('company', '=', company.id),
+                ], fields_names=['date', 'percepcion_base',
+                'percepcion_amount', 'retencion_base', 'retencion_amount'])}
+
+
+def read_lotes(data):
+    "Return the content of each lote of an exported RN 38/11 archive"
+    lotes = {}
+    with zipfile.ZipFile(BytesIO(data)) as archive:
+        for name in archive.namelist():
+            content = archive.read(name)
+            if name.endswith('.ZIP'):
+                lotes.update(read_lotes(content))
+            else:
+                lotes[name] = content.decode('utf-8')
+    return lotes
+
+
+def load_script():
+    loader = importlib.machinery.SourceFileLoader(
+        'trytond_arba_rn3811', SCRIPT)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def census_data(regimen, rates, start_date, end_date):
+    "Return an ARBA census file with the rate of each CUIT"
+    return ''.join(
+        '%s;%s;%s;%s;%s;D;N;N;%s;00;\r\n' % (
+            regimen, start_date.strftime('%d%m%Y'),
+            start_date.strftime('%d%m%Y'), end_date.strftime('%d%m%Y'),
+            vat_number, rate)
+        for vat_number, rate in rates).encode('iso-8859-1')
+
+
+def get_party_rates(party):
+    "Return the ARBA rates stored for the party"
+    pool = Pool()
+    PartyWithholdingIIBB = pool.get('party.retencion.iibb')
+
+    records = PartyWithholdingIIBB.search([('party', '=', party.id)])
+    if not records:
+        return None
+    record, = records
+    return record.rate_percepcion, record.rate_retencion
+
+
+def create_export(start_date, end_date, **values):
+    "Return a RN 38/11 export wizard with the start values"
+    pool = Pool()
+    ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+    session_id, _, _ = ExportARBARN3811.create()
+    export = ExportARBARN3811(session_id)
+    export.start.start_date = start_date
+    export.start.end_date = end_date
+    export.start.csv_format = values.get('csv_format', False)
+    export.start.split_periods = values.get('split_periods', False)
+    export.start.period_type = values.get('period_type', 'month')
+    export.start.single_archive = values.get('single_archive', False)
+    return export
 
 
 class AccountARBATestCase(CompanyTestMixin, ModuleTestCase):
     'Test account_arba module'
     module = 'account_arba'
 
+    def set_config(self, option, value):
+        "Set the account_arba configuration option for the test"
+        if not config.has_section('account_arba'):
+            config.add_section('account_arba')
+            self.addCleanup(config.remove_section, 'account_arba')
+        config.set('account_arba', option, value)
+        self.addCleanup(config.remove_option, 'account_arba', option)
+
+    def test_import_lazy_dependencies(self):
+        "Test module import does not load pyafipws nor stdnum"
+        result = json.loads(subprocess.check_output(
+                [sys.executable, '-c', IMPORT_CODE]))
+
+        self.assertEqual(result['modules'], [])
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        logger.info("account_arba imported in %.3f s, max RSS +%s",
+            result['time'], result['rss'])
+
+    @with_transaction()
+    def test_census_parse(self):
+        "Test parse ARBA census"
+        pool = Pool()
+        Census = pool.get('arba.census')
+        start_date = datetime.date(2024, 1, 1)
+        end_date = datetime.date(2024, 1, 31)
+        data = census_data('P', [
+                ('30710158254', '3,00'),
+                ('20123456786', '0,50'),
+                ], start_date, end_date)
+        result = [
+            ('30710158254', start_date, end_date, Decimal('3.00')),
+            ('20123456786', start_date, end_date, Decimal('0.50')),
+            ]
+
+        self.assertEqual(
+            list(Census._parse_census('percepcion', data)), result)
+
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('PadronRGSPer012024.txt', data)
+        self.assertEqual(
+            list(Census._parse_census('percepcion', archive.getvalue())),
+            result)
+
+    @with_transaction()
+    def test_census_parse_type_mismatch(self):
+        "Test parse ARBA census of another type"
+        pool = Pool()
+        Census = pool.get('arba.census')
+        data = census_data('R', [('30710158254', '3,00')],
+            datetime.date(2024, 1, 1), datetime.date(2024, 1, 31))
+
+        with self.assertRaises(UserError):
+            list(Census._parse_census('percepcion', data))
+        with self.assertRaises(UserError):
+            Census.import_census('percepcion', data)
+
+    @with_transaction()
+    def test_census_get_rates(self):
+        "Test ARBA census rates at date"
+        pool = Pool()
+        Census = pool.get('arba.census')
+        start_date = datetime.date(2024, 1, 1)
+        end_date = datetime.date(2024, 1, 31)
+
+        Census.import_census('percepcion', census_data('P', [
+                    ('30710158254', '3,00'),
+                    ], start_date, end_date))
+        Census.import_census('retencion', census_data('R', [
+                    ('30710158254', '1,50'),
+                    ('20123456786', '0,50'),
+                    ], start_date, end_date))
+
+        self.assertEqual(
+            Census.get_rates(['30710158254', '20123456786', '30688555872'],
+                date=datetime.date(2024, 1, 15)), {
+                '30710158254': (Decimal('3.00'), Decimal('1.50')),
+                '20123456786': (None, Decimal('0.50')),
+                })
+        self.assertEqual(
+            Census.get_rates(['30710158254'], date=end_date),
+            {'30710158254': (Decimal('3.00'), Decimal('1.50'))})
+        self.assertEqual(
+            Census.get_rates(['30710158254'],
+                date=datetime.date(2024, 2, 1)), {})
+
+    @with_transaction()
+    def test_party_census_rates(self):
+        "Test party ARBA rates from census on create and write"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Census = pool.get('arba.census')
+        start_date = Date.today().replace(day=1)
+        end_date = start_date + datetime.timedelta(days=40)
+
+        Census.import_census('percepcion', census_data('P', [
+                    ('30688555872', '3,00'),
+                    ('20123456786', '2,00'),
+                    ('30500010912', '4,00'),
+                    ], start_date, end_date))
+        Census.import_census('retencion', census_data('R', [
+                    ('30688555872', '1,50'),
+                    ('20123456786', '1,00'),
+                    ], start_date, end_date))
+        company = create_arba_company()
+        set_arba_regimenes(company)
+
+        with set_company(company):
+            party = create_party('Customer', '30688555872')
+            self.assertEqual(get_party_rates(party),
+                (Decimal('3.00'), Decimal('1.50')))
+
+            set_vat_number(party, '20123456786')
+            self.assertEqual(get_party_rates(party),
+                (Decimal('2.00'), Decimal('1.00')))
+
+            set_vat_number(party, '30500010912')
+            self.assertEqual(get_party_rates(party),
+                (Decimal('4.00'), None))
+
+            set_vat_number(party, '33693450239')
+            self.assertEqual(get_party_rates(party), (None, None))
+
+            party = create_party('Unknown', '33693450239')
+            self.assertIsNone(get_party_rates(party))
+
+    @with_transaction()
+    def test_party_census_rates_without_regimenes(self):
+        "Test party ARBA rates without company regimenes"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Census = pool.get('arba.census')
+        start_date = Date.today().replace(day=1)
+        end_date = start_date + datetime.timedelta(days=40)
+
+        Census.import_census('percepcion', census_data('P', [
+                    ('30688555872', '3,00'),
+                    ], start_date, end_date))
+        company = create_arba_company()
+
+        with set_company(company):
+            party = create_party('Customer', '30688555872')
+            self.assertIsNone(get_party_rates(party))
+
+    @with_transaction()
+    def test_party_get_arba_data_queue(self):
+        "Test get ARBA data of many parties is queued by chunk"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Job = pool.get('arba.census.job')
+        Queue = pool.get('ir.queue')
+        company = create_arba_company()
+        self.set_config('census_chunk', '2')
+
+        with set_company(company):
+            parties = [create_party('Party %s' % i) for i in range(5)]
+            with patch.object(Party, 'import_arba_census') as import_:
+                Party.get_arba_data(parties[:2])
+                import_.assert_called_once_with(parties[:2])
+                self.assertEqual(Job.search([]), [])
+
+                Party.get_arba_data(parties)
+                import_.assert_called_once()
+
+            job, = Job.search([])
+            self.assertEqual(job.company, company)
+            self.assertEqual(job.total, 5)
+            self.assertEqual(job.state, 'running')
+            tasks = [t for t in Queue.search([], order=[('id', 'ASC')])
+                if t.data['model'] == 'party.party']
+            self.assertEqual(
+                [(t.data['method'], t.data['instances'], list(t.data['args']))
+                    for t in tasks], [
+                    ('import_arba_census_job',
+                        [p.id for p in parties[:2]], [job.id]),
+                    ('import_arba_census_job',
+                        [p.id for p in parties[2:4]], [job.id]),
+                    ('import_arba_census_job',
+                        [p.id for p in parties[4:]], [job.id]),
+                    ])
+
+    @with_transaction()
+    def test_party_get_arba_data_without_company(self):
+        "Test get ARBA data of many parties without company"
+        pool = Pool()
+        Party = pool.get('party.party')
+        self.set_config('census_chunk', '2')
+
+        parties = [create_party('Party %s' % i) for i in range(3)]
+        with Transaction().set_context(company=None):
+            with self.assertRaises(UserError):
+                Party.get_arba_data(parties)
+
+    @with_transaction()
+    def test_census_job_progress(self):
+        "Test ARBA census job counts processed and failed chunks"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Job = pool.get('arba.census.job')
+        company = create_arba_company()
+
+        def read_job(job):
+            values, = Job.read([job.id],
+                ['state', 'processed', 'failed', 'progress', 'error'])
+            values.pop('id')
+            return values
+
+        with set_company(company):
+            parties = [create_party('Party %s' % i) for i in range(5)]
+            job = Job(total=5)
+            job.save()
+            self.assertEqual(job.company, company)
+
+            with patch.object(
+                    Party, 'import_arba_census', return_value=True):
+                Party.import_arba_census_job(parties[:2], job.id)
+                Party.import_arba_census_job(parties[2:4], job.id)
+            self.assertEqual(read_job(job), {
+                    'state': 'running',
+                    'processed': 4,
+                    'failed': 0,
+                    'progress': 0.8,
+                    'error': None,
+                    })
+
+            # Retryable errors are left to the worker
+            with patch.object(Party, 'import_arba_census',
+                    side_effect=backend.DatabaseOperationalError):
+                with self.assertRaises(backend.DatabaseOperationalError):
+                    Party.import_arba_census_job(parties[4:], job.id)
+            self.assertEqual(read_job(job), {
+                    'state': 'running',
+                    'processed': 4,
+                    'failed': 0,
+                    'progress': 0.8,
+                    'error': None,
+                    })
+
+            # The web service is not configured
+            with patch.object(
+                    Party, 'import_arba_census', return_value=False):
+                Party.import_arba_census_job(parties[4:], job.id)
+            values = read_job(job)
+            self.assertTrue(values.pop('error'))
+            self.assertEqual(values, {
+                    'state': 'failed',
+                    'processed': 4,
+                    'failed': 1,
+                    'progress': 1.,
+                    })
+
+    @with_transaction()
+    def test_party_arba_rates_cache(self):
+        "Test party ARBA rates are cached until the rates change"
+        pool = Pool()
+        Party = pool.get('party.party')
+        PartyWithholdingIIBB = pool.get('party.retencion.iibb')
+        company = create_arba_company()
+
+        with set_company(company):
+            set_arba_regimenes(company)
+            party = create_party('Customer', '30688555872')
+            Party._set_arba_rates(company, {
+                    party: (Decimal('2.50'), Decimal('1.00')),
+                    })
+
+            with patch.object(PartyWithholdingIIBB, 'search',
+                    wraps=PartyWithholdingIIBB.search) as search:
+                for _ in range(2):
+                    self.assertEqual(
+                        Party.get_arba_rates([party], company=company),
+                        {party.id: (Decimal('2.50'), Decimal('1.00'))})
+                self.assertEqual(search.call_count, 1)
+
+            record, = PartyWithholdingIIBB.search([
+                    ('party', '=', party.id),
+                    ])
+            PartyWithholdingIIBB.write([record], {
+                    'rate_percepcion': Decimal('4.00'),
+                    })
+            self.assertIsNone(
+                Party._arba_rates_cache.get((company.id, party.id)))
+            self.assertEqual(
+                Party.get_arba_rates([party], company=company),
+                {party.id: (Decimal('4.00'), Decimal('1.00'))})
+
+    @with_transaction()
+    def test_tax_arba_rate_percepcion(self):
+        "Test percepción tax uses the cached party ARBA rate"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Party = pool.get('party.party')
+        PartyWithholdingIIBB = pool.get('party.retencion.iibb')
+        Tax = pool.get('account.tax')
+        company = create_arba_company()
+
+        with set_company(company):
+            percepcion, _ = set_arba_regimenes(company)
+            party = create_party('Customer', '30688555872')
+            Party._set_arba_rates(company, {
+                    party: (Decimal('2.50'), None),
+                    })
+
+            with patch.object(PartyWithholdingIIBB, 'search',
+                    wraps=PartyWithholdingIIBB.search) as search, \
+                    Transaction().set_context(party=party.id):
+                for _ in range(2):
+                    taxline, = Tax.compute(Tax.browse([percepcion]),
+                        Decimal(100), 1, Date.today())
+                    self.assertEqual(taxline['amount'], Decimal('2.5'))
+                self.assertEqual(search.call_count, 1)
+
+    @with_transaction()
+    def test_period_total_update_totals(self):
+        "Test ARBA period totals update"
+        pool = Pool()
+        PeriodTotal = pool.get('arba.period.total')
+        company = create_arba_company()
+        january = datetime.date(2024, 1, 1)
+        january2 = datetime.date(2024, 1, 16)
+
+        # New period
+        PeriodTotal.update_totals([], [
+                (company.id, datetime.date(2024, 1, 10),
+                    Decimal(100), Decimal(3), Decimal(0), Decimal(0)),
+                None,
+                ])
+        self.assertEqual(read_period_totals(company), {
+                january: (Decimal(100), Decimal(3), Decimal(0), Decimal(0)),
+                })
+
+        # Existing period
+        PeriodTotal.update_totals([], [
+                (company.id, datetime.date(2024, 1, 15),
+                    Decimal(0), Decimal(0), Decimal(50), Decimal(1)),
+                ])
+        self.assertEqual(read_period_totals(company), {
+                january: (Decimal(100), Decimal(3), Decimal(50), Decimal(1)),
+                })
+
+        # Moved to the next fortnight
+        PeriodTotal.update_totals([
+                (company.id, datetime.date(2024, 1, 10),
+                    Decimal(100), Decimal(3), Decimal(0), Decimal(0)),
+                ], [
+                (company.id, datetime.date(2024, 1, 20),
+                    Decimal(100), Decimal(3), Decimal(0), Decimal(0)),
+                ])
+        self.assertEqual(read_period_totals(company), {
+                january: (Decimal(0), Decimal(0), Decimal(50), Decimal(1)),
+                january2: (Decimal(100), Decimal(3), Decimal(0), Decimal(0)),
+                })
+        self.assertEqual(
+            PeriodTotal.get_totals(company,
+                datetime.date(2024, 1, 1), datetime.date(2024, 1, 31)),
+            (Decimal(100), Decimal(3), Decimal(50), Decimal(1)))
+        self.assertEqual(
+            PeriodTotal.get_totals(company,
+                datetime.date(2024, 1, 16), datetime.date(2024, 1, 31)),
+            (Decimal(100), Decimal(3), Decimal(0), Decimal(0)))
+
+        # Nothing changes
+        PeriodTotal.update_totals([
+                (company.id, datetime.date(2024, 1, 20),
+                    Decimal(100), Decimal(3), Decimal(0), Decimal(0)),
+                ], [
+                (company.id, datetime.date(2024, 1, 25),
+                    Decimal(100), Decimal(3), Decimal(0), Decimal(0)),
+                ])
+        self.assertEqual(len(read_period_totals(company)), 2)
+
+    @with_transaction()
+    def test_period_total_invoice(self):
+        "Test ARBA period totals of posted and cancelled invoices"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Invoice = pool.get('account.invoice')
+        date = datetime.date(2024, 1, 10)
+        company, invoice_type, percepcion, _ = setup_arba_company(
+            'Company', '30710158254', date)
+        company.cancel_invoice_out = True
+        company.save()
+
+        with set_company(company):
+            customer = create_party('Customer', '30688555872')
+            Party._set_arba_rates(company, {
+                    customer: (Decimal('3.00'), None),
+                    })
+
+            draft = create_invoice(invoice_type, customer, date,
+                Decimal(50), [percepcion], post=False)
+            self.assertEqual(read_period_totals(company), {})
+
+            invoice = create_invoice(
+                invoice_type, customer, date, Decimal(100), [percepcion])
+            totals = {datetime.date(2024, 1, 1): (
+                    Decimal(100), Decimal(3), Decimal(0), Decimal(0))}
+            self.assertEqual(read_period_totals(company), totals)
+
+            # Cancelled invoices with number are still exported
+            Invoice.cancel([invoice, draft])
+            self.assertEqual(read_period_totals(company), totals)
+
+    @with_transaction()
+    def test_period_total_retencion(self):
+        "Test ARBA period totals of issued withholdings"
+        pool = Pool()
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        date = datetime.date(2024, 1, 20)
+        company = create_arba_company()
+        zero = Decimal(0)
+
+        with set_company(company):
+            _, regimen = set_arba_regimenes(company)
+            supplier = create_party('Supplier', '30688555872')
+            retencion, = TaxWithholdingSubmitted.create([{
+                        'name': '0001',
+                        'tax': regimen.id,
+                        'party': supplier.id,
+                        'date': date,
+                        'payment_amount': Decimal(200),
+                        'amount': Decimal(4),
+                        'state': 'draft',
+                        }])
+            self.assertEqual(read_period_totals(company), {})
+
+            TaxWithholdingSubmitted.write([retencion], {'state': 'issued'})
+            self.assertEqual(read_period_totals(company), {
+                    datetime.date(2024, 1, 16): (
+                        zero, zero, Decimal(200), Decimal(4)),
+                    })
+
+            TaxWithholdingSubmitted.write([retencion], {'state': 'draft'})
+            self.assertEqual(read_period_totals(company), {
+                    datetime.date(2024, 1, 16): (zero, zero, zero, zero),
+                    })
+
+            TaxWithholdingSubmitted.write([retencion], {'state': 'issued'})
+            TaxWithholdingSubmitted.delete([retencion])
+            self.assertEqual(read_period_totals(company), {
+                    datetime.date(2024, 1, 16): (zero, zero, zero, zero),
+                    })
+
+    @with_transaction()
+    def test_period_total_rebuild(self):
+        "Test rebuild ARBA period totals"
+        pool = Pool()
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        PeriodTotal = pool.get('arba.period.total')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        Rebuild = pool.get('arba.period.total.rebuild', type='wizard')
+        date = datetime.date(2024, 1, 10)
+        company, invoice_type, percepcion, regimen = setup_arba_company(
+            'Company', '30710158254', date)
+        other = create_arba_company('Other', '30500010912')
+        Company.write([other], {
+                'arba_regimen_retencion': regimen.id,
+                })
+
+        with set_company(company):
+            customer = create_party('Customer', '30688555872')
+            Party._set_arba_rates(company, {
+                    customer: (Decimal('3.00'), None),
+                    })
+            create_invoice(
+                invoice_type, customer, date, Decimal(100), [percepcion])
+            TaxWithholdingSubmitted.create([{
+                        'name': '0001',
+                        'tax': regimen.id,
+                        'party': customer.id,
+                        'date': date,
+                        'payment_amount': Decimal(200),
+                        'amount': Decimal(4),
+                        'state': 'issued',
+                        }])
+            totals = read_period_totals(company)
+            other_totals = read_period_totals(other)
+            self.assertTrue(other_totals)
+            # Period totals from before the module update are missing
+            PeriodTotal.delete(PeriodTotal.search([
+                        ('company', '=', company.id),
+                        ]))
+
+            session_id, _, _ = Rebuild.create()
+            rebuild = Rebuild(session_id)
+            rebuild.start.start_date = datetime.date(2024, 1, 1)
+            rebuild.start.end_date = datetime.date(2024, 1, 31)
+            self.assertEqual(rebuild.transition_rebuild(), 'end')
+            Rebuild.delete(session_id)
+
+            self.assertEqual(read_period_totals(company), totals)
+            # The totals of the company sharing the regimen are unchanged
+            self.assertEqual(read_period_totals(other), other_totals)
+
+    @with_transaction()
+    def test_rn3811_periods(self):
+        "Test RN 38/11 periods"
+        start_date = datetime.date(2024, 1, 1)
+        end_date = datetime.date(2024, 2, 15)
+
+        export = create_export(start_date, end_date)
+        self.assertEqual(export._get_periods(), ['2024010'])
+        self.assertEqual(
+            export._get_period(datetime.date(2024, 2, 10)), '2024010')
+
+        export = create_export(start_date, end_date,
+            split_periods=True, period_type='month')
+        self.assertEqual(export._get_periods(), ['2024010', '2024020'])
+        self.assertEqual(
+            export._get_period(datetime.date(2024, 2, 10)), '2024020')
+
+        export = create_export(start_date, end_date,
+            split_periods=True, period_type='fortnight')
+        self.assertEqual(
+            export._get_periods(), ['2024011', '2024012', '2024021'])
+        self.assertEqual(
+            export._get_period(datetime.date(2024, 1, 15)), '2024011')
+        self.assertEqual(
+            export._get_period(datetime.date(2024, 1, 16)), '2024012')
+
+    @with_transaction()
+    def test_rn3811_filenames(self):
+        "Test RN 38/11 file names"
+        vat_number = '30710158254'
+
+        export = create_export(
+            datetime.date(2024, 1, 1), datetime.date(2024, 1, 31))
+        files = list(export._get_lote_files(
+                vat_number, '7', {'2024010': ['record\r\n']}))
+        self.assertEqual(files, [(
+                    'AR-30710158254-2024010-7-2024010.ZIP',
+                    'AR-30710158254-2024010-7-2024010.TXT',
+                    b'record\r\n')])
+        self.assertEqual(
+            export._get_archive_filename(vat_number, '7', files),
+            'AR-30710158254-2024010-7-2024010.ZIP')
+
+        export = create_export(
+            datetime.date(2024, 1, 1), datetime.date(2024, 1, 31),
+            csv_format=True, split_periods=True, period_type='fortnight')
+        files = list(export._get_lote_files(
+                vat_number, '6', {'2024011': [], '2024012': []}))
+        self.assertEqual([f[:2] for f in files], [
+                ('AR-30710158254-2024011-6-2024011.ZIP',
+                    'AR-30710158254-2024011-6-2024011.CSV'),
+                ('AR-30710158254-2024012-6-2024012.ZIP',
+                    'AR-30710158254-2024012-6-2024012.CSV'),
+                ])
+        self.assertEqual(
+            export._get_archive_filename(vat_number, '6', files),
+            'AR-30710158254-2024011-6-2024012.ZIP')
+        self.assertEqual(
+            export._get_archive_filename(vat_number),
+            'AR-30710158254-2024011-2024012.ZIP')
+
+    @with_transaction()
+    def test_rn3811_zip_single_lote(self):
+        "Test RN 38/11 ZIP of a single lote"
+        pool = Pool()
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+        data = ExportARBARN3811.get_content([
+                ('AR-1-2024010-7-2024010.ZIP', 'AR-1-2024010-7-2024010.TXT',
+                    b'record\r\n' * 10)])
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            info, = archive.infolist()
+            self.assertEqual(info.filename, 'AR-1-2024010-7-2024010.TXT')
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(
+                archive.read(info), b'record\r\n' * 10)
+
+    @with_transaction()
+    def test_rn3811_zip_stored(self):
+        "Test RN 38/11 ZIP without compression"
+        pool = Pool()
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+        self.set_config('zip_compression', 'stored')
+
+        data = ExportARBARN3811.get_content([
+                ('AR-1-2024010-7-2024010.ZIP', 'AR-1-2024010-7-2024010.TXT',
+                    b'record\r\n')])
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            info, = archive.infolist()
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+    @with_transaction()
+    def test_rn3811_zip_several_lotes(self):
+        "Test RN 38/11 ZIP of several lotes"
+        pool = Pool()
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+
+        data = ExportARBARN3811.get_content([
+                ('AR-1-2024011-7-2024011.ZIP', 'AR-1-2024011-7-2024011.TXT',
+                    b'first\r\n'),
+                ('AR-1-2024012-7-2024012.ZIP', 'AR-1-2024012-7-2024012.TXT',
+                    b'second\r\n'),
+                ])
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            self.assertEqual(archive.namelist(), [
+                    'AR-1-2024011-7-2024011.ZIP',
+                    'AR-1-2024012-7-2024012.ZIP',
+                    ])
+            for info in archive.infolist():
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(read_lotes(data), {
+                'AR-1-2024011-7-2024011.TXT': 'first\r\n',
+                'AR-1-2024012-7-2024012.TXT': 'second\r\n',
+                })
+
+    @with_transaction()
+    def test_rn3811_get_files(self):
+        "Test RN 38/11 files by lote and in a single archive"
+        start_date = datetime.date(2024, 1, 1)
+        end_date = datetime.date(2024, 1, 31)
+        company = create_arba_company(vat_number='30710158254')
+
+        with set_company(company):
+            export = create_export(start_date, end_date)
+            files, message = export.get_files()
+            self.assertEqual(message, '')
+            self.assertEqual(
+                [(f, [l[1] for l in lotes]) for f, lotes in files], [
+                    ('AR-30710158254-2024010-7-2024010.ZIP',
+                        ['AR-30710158254-2024010-7-2024010.TXT']),
+                    ('AR-30710158254-2024010-6-2024010.ZIP',
+                        ['AR-30710158254-2024010-6-2024010.TXT']),
+                    ])
+
+            export = create_export(start_date, end_date,
+                split_periods=True, period_type='fortnight',
+                single_archive=True)
+            files, message = export.get_files()
+            (filename, lotes), = files
+            self.assertEqual(filename, 'AR-30710158254-2024011-2024012.ZIP')
+            self.assertEqual([l[0] for l in lotes], [
+                    'AR-30710158254-2024011-7-2024011.ZIP',
+                    'AR-30710158254-2024012-7-2024012.ZIP',
+                    'AR-30710158254-2024011-6-2024011.ZIP',
+                    'AR-30710158254-2024012-6-2024012.ZIP',
+                    ])
+
+    @with_transaction()
+    def test_rn3811_export_companies(self):
+        "Test RN 38/11 export only includes the company invoices"
+        pool = Pool()
+        Company = pool.get('company.company')
+        date = datetime.date(2024, 1, 10)
+
+        company1, invoice_type1, percepcion1, _ = setup_arba_company(
+            'Company 1', '30710158254', date)
+        company2, invoice_type2, percepcion2, _ = setup_arba_company(
+            'Company 2', '30500010912', date, currency=company1.currency)
+        with set_company(company1):
+            customer1 = create_party('Customer 1', '30688555872')
+            create_invoice(
+                invoice_type1, customer1, date, Decimal(100), [percepcion1])
+        with set_company(company2):
+            customer2 = create_party('Customer 2', '20123456786')
+            create_invoice(
+                invoice_type2, customer2, date, Decimal(100), [percepcion2])
+
+        # The export is not limited by the record rules of the user
+        with Transaction().set_user(0), \
+                Transaction().set_context(
+                    companies=[company1.id, company2.id]), \
+                tempfile.TemporaryDirectory() as path:
+            filenames = Company.export_arba_rn3811_files(
+                [company1, company2], path,
+                datetime.date(2024, 1, 1), datetime.date(2024, 1, 31))
+            lotes = {}
+            for filename in filenames:
+                with open(filename, 'rb') as file_:
+                    lotes.update(read_lotes(file_.read()))
+            attachments = Company.export_arba_rn3811(
+                [company1, company2],
+                datetime.date(2024, 1, 1), datetime.date(2024, 1, 31))
+
+        self.assertEqual(
+            sorted(os.path.basename(f) for f in filenames),
+            sorted(a.name for a in attachments))
+        lote1 = lotes['AR-30710158254-2024010-7-2024010.TXT']
+        lote2 = lotes['AR-30500010912-2024010-7-2024010.TXT']
+        self.assertIn('30-68855587-2', lote1)
+        self.assertNotIn('20-12345678-6', lote1)
+        self.assertIn('20-12345678-6', lote2)
+        self.assertNotIn('30-68855587-2', lote2)
+        for attachment in attachments:
+            self.assertEqual(attachment.resource.__name__, 'company.company')
+            for name, content in read_lotes(attachment.data).items():
+                self.assertEqual(lotes[name], content)
+
+    @unittest.skipUnless(os.path.exists(SCRIPT), "requires the script")
+    def test_rn3811_script_options(self):
+        "Test RN 38/11 script options"
+        script = load_script()
+        parser = script.get_parser()
+
+        options = parser.parse_args([
+                '-d', 'test', '--company', '1', '2',
+                '--start-date', '2024-01-01', '--end-date', '2024-01-31'])
+        self.assertEqual(options.companies, [1, 2])
+        self.assertEqual(options.start_date, datetime.date(2024, 1, 1))
+        self.assertEqual(options.end_date, datetime.date(2024, 1, 31))
+        self.assertIsNone(options.period_type)
+        self.assertFalse(options.single_archive)
+        self.assertEqual(options.processes, 1)
+
+        options = parser.parse_args([
+                '-d', 'test', '--company', '1',
+                '--start-date', '2024-01-01', '--end-date', '2024-01-31',
+                '--split-periods', 'fortnight', '--single-archive',
+                '--csv', '-o', '/tmp', '-p', '4'])
+        self.assertEqual(options.period_type, 'fortnight')
+        self.assertTrue(options.single_archive)
+        self.assertTrue(options.csv_format)
+        self.assertEqual(options.path, '/tmp')
+        self.assertEqual(options.processes, 4)
+
+    @with_transaction()
+    def test_rn3811_preview(self):
+        "Test RN 38/11 preview matches the exported lotes"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Invoice = pool.get('account.invoice')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        date = datetime.date(2024, 1, 10)
+        company, invoice_type, percepcion, regimen = setup_arba_company(
+            'Company', '30710158254', date)
+        cursor = Transaction().connection.cursor()
+        invoice_table = Invoice.__table__()
+
+        with set_company(company):
+            customer = create_party('Customer', '30688555872')
+            without_cuit = create_party('Without CUIT', '20123456786')
+            consumer = create_party('Consumer')
+            Party._set_arba_rates(company, {
+                    customer: (Decimal('3.00'), None),
+                    without_cuit: (Decimal('3.00'), None),
+                    })
+            invoice = create_invoice(
+                invoice_type, customer, date, Decimal(100), [percepcion])
+            create_invoice(
+                invoice_type, customer, date, Decimal(40), [])
+            create_invoice(
+                invoice_type, without_cuit, date, Decimal(50), [percepcion])
+            Party.write([without_cuit], {
+                    'identifiers': [
+                        ('delete', [i.id for i in without_cuit.identifiers]),
+                        ],
+                    })
+            # The export computes untaxed_amount without cache
+            cursor.execute(*invoice_table.update(
+                    [invoice_table.untaxed_amount_cache], [Null],
+                    where=invoice_table.id == invoice.id))
+            TaxWithholdingSubmitted.create([{
+                        'name': name,
+                        'tax': regimen.id,
+                        'party': party.id,
+                        'date': date,
+                        'payment_amount': base,
+                        'amount': amount,
+                        'state': 'issued',
+                        } for name, party, base, amount in [
+                        ('0001', customer, Decimal(200), Decimal(4)),
+                        ('0002', customer, None, Decimal(2)),
+                        ('0003', consumer, Decimal(300), Decimal(6)),
+                        ]])
+
+            export = create_export(datetime.date(2024, 1, 1),
+                datetime.date(2024, 1, 31), csv_format=True)
+            preview = export.get_preview()
+            lote12, lote19, message = export.get_lotes()
+
+        lines12 = [r.split(';') for p in lote12.values() for r in p]
+        lines19 = [r.split(';') for p in lote19.values() for r in p]
+        errors = [m for m in message.splitlines() if m.startswith('ERROR')]
+        self.assertEqual(preview, {
+                'lote12_lines': len(lines12),
+                'lote12_rejected_cuit': len([m for m in errors
+                        if m.startswith('ERROR: La factura')]),
+                'lote12_base': sum(Decimal(l[6]) for l in lines12),
+                'lote12_amount': sum(Decimal(l[7]) for l in lines12),
+                'lote19_lines': len(lines19),
+                'lote19_rejected_cuit': len([m for m in errors
+                        if m.startswith('ERROR: La retención')
+                        and 'CUIT' in m]),
+                'lote19_rejected_base': len([m for m in errors
+                        if 'Monto imponible' in m]),
+                'lote19_base': sum(Decimal(l[1]) for l in lines19),
+                'lote19_amount': sum(Decimal(l[2]) for l in lines19),
+                })
+        self.assertEqual(preview, {
+                'lote12_lines': 1,
+                'lote12_rejected_cuit': 1,
+                'lote12_base': Decimal(100),
+                'lote12_amount': Decimal(3),
+                'lote19_lines': 1,
+                'lote19_rejected_cuit': 1,
+                'lote19_rejected_base': 1,
+                'lote19_base': Decimal(200),
+                'lote19_amount': Decimal(4),
+                })
+
+    def assertIndexScan(self, query, *indexes):
+        "Assert the query plan uses the indexes declared on the models"
+        cursor = Transaction().connection.cursor()
+        names = []
+        for Model, index in indexes:
+            self.assertIn(index, Model._sql_indexes)
+            table = backend.TableHandler(Model)
+            name, _, _ = table.index_translator_for(index).definition(index)
+            names.append('idx_' + table.convert_name(
+                    '_'.join([table.table_name, name]),
+                    reserved=len('idx_')))
+        # With sequential scans disabled, PostgreSQL plans the cheapest
+        # index even on the empty tables of the test database
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        sql, params = tuple(query)
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = '\n'.join(line for line, in cursor)
+        self.assertNotIn('Seq Scan', plan, msg=plan)
+        for name in names:
+            self.assertIn(name, plan)
+
+    @unittest.skipUnless(
+        backend.name == 'postgresql', "requires PostgreSQL query plans")
+    @with_transaction()
+    def test_rn3811_export_queries_use_indexes(self):
+        "Test RN 38/11 export queries use indexes"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        ExportARBARN3811 = pool.get('arba.rn3811', type='wizard')
+        invoice = Invoice.__table__()
+        retencion = TaxWithholdingSubmitted.__table__()
+        start_date = datetime.date(2024, 1, 1)
+        end_date = datetime.date(2024, 1, 31)
+
+        # The move.date range is served by the (date, number) index of
+        # account, which is covered by the check on sequential scans
+        self.assertIndexScan(Invoice.search(
+                ExportARBARN3811._get_lote12_domain(
+                    1, start_date, end_date),
+                order=ExportARBARN3811._lote12_order, query=True),
+            (Invoice, Index(invoice,
+                    (invoice.move, Index.Range()),
+                    where=invoice.type == 'out')))
+        self.assertIndexScan(TaxWithholdingSubmitted.search(
+                ExportARBARN3811._get_lote19_domain(1, start_date, end_date),
+                order=ExportARBARN3811._lote19_order, query=True),
+            (TaxWithholdingSubmitted, Index(retencion,
+                    (retencion.tax, Index.Equality()),
+                    (retencion.date, Index.Range()),
+                    where=retencion.state == 'issued')))
 
 del ModuleTestCase